@@ -0,0 +1,12 @@
+# Type declarations used only by the optional Cython build (see setup.py).
+# Plain Python imports of biodome.py never read this file.
+#
+# Note that module-level names declared here become C globals in the compiled
+# module and are no longer visible as module attributes.
+
+cdef frozenset _TRUTHY
+cdef Py_ssize_t _TRUTHY_MAXLEN
+cdef frozenset _CACHEABLE
+cdef dict _CAST_DISPATCH
+
+cpdef bint _parse_bool(str raw_value)
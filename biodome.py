@@ -20,13 +20,10 @@ Controlled environments.
 
 """
 from __future__ import annotations
-import ast
-import contextlib
-import errno
-import functools
 import logging
 import os
-from collections import UserDict
+import sys
+from collections.abc import MutableMapping
 import typing
 
 
@@ -40,6 +37,119 @@ if typing.TYPE_CHECKING:  # pragma: no cover
 __version__ = "2022.9.1"
 logger = logging.getLogger(__name__)
 
+# Lowercased values that are treated as True when casting to bool.
+_TRUTHY = frozenset((
+    "1",
+    "y",
+    "yes",
+    "on",
+    "active",
+    "activated",
+    "enabled",
+    "true",
+    "t",
+    "ok",
+    "yeah",
+))
+
+_TRUTHY_MAXLEN = max(map(len, _TRUTHY))
+
+# Bound method hoisted out of the bool parser. os.environ itself is always
+# looked up at call time, since tests commonly replace it with a mock.
+_TRUTHY_contains = _TRUTHY.__contains__
+
+
+def _parse_bool(raw_value):
+    raw_value = raw_value.strip()
+    # Longer values can't be truthy, so don't bother lowercasing them.
+    return len(raw_value) <= _TRUTHY_MAXLEN and _TRUTHY_contains(raw_value.lower())
+
+
+# json and ast are only needed for container values, so they aren't
+# imported until the first one is parsed. Each of these stand-ins rebinds
+# its own global name to the real function the first time it's called.
+def _json_loads(raw_value):
+    global _json_loads
+    from json import loads as _json_loads
+    return _json_loads(raw_value)
+
+
+def _literal_eval(raw_value):
+    global _literal_eval
+    from ast import literal_eval as _literal_eval
+    return _literal_eval(raw_value)
+
+
+def _literal(raw_value):
+    """Parse a container literal, trying the (much faster) C json parser
+    before falling back to ast for Python-only syntax."""
+    try:
+        return _json_loads(raw_value)
+    except ValueError:
+        return _literal_eval(raw_value)
+
+
+def _set_literal(raw_value):
+    """Parse a set literal. JSON has no sets, but the elements of {1, 2}
+    parse exactly like the JSON array [1, 2]."""
+    if raw_value[:1] == "{" and raw_value[-1:] == "}":
+        try:
+            return set(_json_loads("[" + raw_value[1:-1] + "]"))
+        except ValueError:
+            pass
+    return _literal_eval(raw_value)
+
+
+def _tuple_literal(raw_value):
+    # Looks up _literal_eval on every call, so that it gets the real function
+    # once the stand-in has replaced itself.
+    return _literal_eval(raw_value)
+
+
+def _parse_collection(type_, parse_literal, openers=None):
+    """Make a parser for a container type. Empty or mismatched values
+    parse to None, so that the default is used instead. If ``openers`` is
+    given, values not starting with one of those characters can't be a
+    literal of the type, and are rejected without being parsed at all."""
+
+    def parse(raw_value):
+        raw_value = raw_value.strip()
+        if openers is not None and raw_value[:1] not in openers:
+            raise ValueError("Not a %s literal" % type_.__name__)
+        value = parse_literal(raw_value)
+        return value if type(value) is type_ and value else None
+
+    return parse
+
+
+# The characters that a list, or a dict or set, literal can start with. The
+# "(" is for parenthesized literals like "([1])". Tuples don't need brackets
+# at all: "1, 2" is a tuple.
+_LIST_OPENERS = frozenset("[(")
+_DICT_SET_OPENERS = frozenset("{(")
+
+
+# Parsers for the types that need more than a plain call. Each takes the
+# raw, unstripped value. Any other type (or cast), int and float included,
+# is called with the stripped value: str.strip() removes more characters
+# (such as \x1c-\x1f) than int() and float() skip on their own.
+_CAST_DISPATCH = {
+    bool: _parse_bool,
+    str: str.strip,
+    list: _parse_collection(list, _literal, _LIST_OPENERS),
+    dict: _parse_collection(dict, _literal, _DICT_SET_OPENERS),
+    set: _parse_collection(set, _set_literal, _DICT_SET_OPENERS),
+    # JSON has no tuple syntax that could stand in for (1,) versus (1).
+    tuple: _parse_collection(tuple, _tuple_literal),
+}
+
+# Successful casts to these types are cached per (name, type). Each entry
+# remembers the raw string it was parsed from, so a changed env var, however
+# it was changed, is simply a cache miss. Only immutable (hashable) values
+# are kept, so a tuple is cached but a tuple holding a list is not.
+_CACHEABLE = frozenset((bool, int, float, str, tuple))
+_cache = {}
+
 
 @typing.overload
 def biodome(name: str) -> str|None: ...  # pragma: no cover
@@ -56,56 +166,107 @@ def biodome(name: str, *, cast: Callable[[str|None], T]) -> T: ...  # pragma: no
 def biodome(name: str, default: T|None = None, *, cast: None|Callable[[str|None], T] = None) -> T|str|None: ...  # pragma: no cover
 def biodome(name, default=None, *, cast=None):
     raw_value = os.environ.get(name)
-    if default is None and cast is None:
-        return raw_value
-
-    if default is not None and cast is not None:
-        raise ValueError("Either default or cast must be provided, not both.")
-
-    if raw_value is None:
-        if default is None and cast is not None:
-            return cast(raw_value)
-        else:
+    if cast is None:
+        if default is None:
+            return raw_value
+        if raw_value is None:
             return default
-
-    raw_value = raw_value.strip()
+    elif default is not None:
+        raise ValueError("Either default or cast must be provided, not both.")
+    elif raw_value is None:
+        return cast(raw_value)
 
     # Use the same type as default as the cast
-    type_ = cast or type(default)
-
-    if bool in (cast, type_):
-        return raw_value.lower() in (
-            "1",
-            "y",
-            "yes",
-            "on",
-            "active",
-            "activated",
-            "enabled",
-            "true",
-            "t",
-            "ok",
-            "yeah",
+    if cast is None or type(cast) is type:
+        type_ = type(default) if cast is None else cast
+        return _convert(
+            (name, type_), raw_value, default, _CAST_DISPATCH.get(type_), type_ in _CACHEABLE
         )
+    # Any other callable may well be unhashable, so keep it away from the
+    # dispatch table and the cache.
+    return _convert((name, cast), raw_value, default, None, False)
+
+
+def _convert(key, raw_value, default, fn, cacheable):
+    """Cast a raw (present) env var value, falling back to the default on
+    failure. ``key`` is the (name, type) being read and ``fn`` the parser for
+    that type, if there is one. Everything except the raw value depends only
+    on the call site, so get_callable() readers work it out just once."""
+    if cacheable:
+        hit = _cache.get(key)
+        if hit is not None and hit[0] == raw_value:
+            return hit[1]
 
     try:
-        if type_ in (dict, list, set, tuple):
-            raw_value = ast.literal_eval(raw_value)
-            return (type(raw_value) == type_ and raw_value) or default
-        return type_(raw_value)
-    except:
-        logger.error(
-            'Env var %s: cast "%s" to type %s failed. The default will be used.',
-            name,
-            raw_value,
-            str(type_),
-        )
+        if fn is None:
+            value = key[1](raw_value.strip())
+        else:
+            value = fn(raw_value)
+    except (
+        ValueError, TypeError, ArithmeticError, SyntaxError, MemoryError, RecursionError
+    ):
+        if logger.isEnabledFor(logging.ERROR):
+            name, type_ = key
+            logger.error(
+                'Env var %s: cast "%s" to type %r failed. The default will be used.',
+                name,
+                raw_value,
+                type_,
+            )
+        return default
+
+    if value is None:
         return default
+    if cacheable:
+        try:
+            hash(value)
+        except TypeError:
+            return value
+        _cache[key] = (raw_value, value)
+    return value
 
 
-class _Environ(UserDict):
-    def __init__(self):
-        self.data = os.environ
+biodome.cache_clear = _cache.clear
+
+
+def materialize(schema):
+    # type: (typing.Mapping[str, typing.Any]) -> dict
+    """
+    Read many env vars in one pass. ``schema`` maps each env var name to
+    its default, which determines the type exactly as it does for
+    ``biodome()``. A dict of the resulting values is returned:
+
+        settings = materialize({'TIMEOUT': 10, 'DEBUG': False, 'HOSTS': []})
+
+    """
+    values = {}
+    for name, default in schema.items():
+        raw_value = os.environ.get(name)
+        if raw_value is None or default is None:
+            values[name] = default if raw_value is None else raw_value
+        else:
+            type_ = type(default)
+            values[name] = _convert(
+                (name, type_),
+                raw_value,
+                default,
+                _CAST_DISPATCH.get(type_),
+                type_ in _CACHEABLE,
+            )
+    return values
+
+
+class _Environ(MutableMapping):
+    # The read side of the mapping protocol is forwarded straight to the
+    # bound methods of os.environ, so no extra Python frame is involved.
+    __slots__ = ()
+
+    data = os.environ
+    __getitem__ = staticmethod(os.environ.__getitem__)
+    __delitem__ = staticmethod(os.environ.__delitem__)
+    __contains__ = staticmethod(os.environ.__contains__)
+    __iter__ = staticmethod(os.environ.__iter__)
+    __len__ = staticmethod(os.environ.__len__)
 
     @typing.overload
     def get(self, key: str) -> str|None: ...  # pragma: no cover
@@ -136,35 +297,85 @@ class _Environ(UserDict):
     @typing.overload
     def get_callable(self, key: str, default: T|None = None, *, cast: None|Callable[[str|None], T] = None) -> Callable[[], T|str|None]: ...  # pragma: no cover
     def get_callable(self, key, default=None, cast=None) -> Callable[[], T|str|None]:
-        return functools.partial(self.get, key, default=default, cast=cast)
+        if default is None and cast is None:
+            def read_raw():
+                return os.environ.get(key)
+
+            return read_raw
+
+        if default is not None and cast is not None:
+            raise ValueError("Either default or cast must be provided, not both.")
+
+        # Resolve everything about the cast once, so that each call is only
+        # the env var read and the conversion itself.
+        type_ = type(default) if cast is None else cast
+        # Interned, so that cache lookups from this reader and from literal
+        # names in biodome() calls compare by identity. sys.intern() only
+        # accepts exact str, not subclasses such as str-based enums.
+        if type(key) is str:
+            key = sys.intern(key)
+        cache_key = (key, type_)
+        if cast is None or type(cast) is type:
+            fn = _CAST_DISPATCH.get(type_)
+            cacheable = type_ in _CACHEABLE
+        else:
+            # Possibly unhashable, see biodome().
+            fn = None
+            cacheable = False
+
+        def read():
+            raw_value = os.environ.get(key)
+            if raw_value is None:
+                return default if cast is None else cast(raw_value)
+            # Inline the cache check from _convert(), so that polling an
+            # unchanged env var costs no further call.
+            if cacheable:
+                hit = _cache.get(cache_key)
+                if hit is not None and hit[0] == raw_value:
+                    return hit[1]
+            return _convert(cache_key, raw_value, default, fn, cacheable)
+
+        return read
 
     def __setitem__(self, key, value):
         os.environ[key] = str(value)
 
+    def __repr__(self):
+        return repr(os.environ)
+
 
 environ = _Environ()
 
 
-@contextlib.contextmanager
-def env_change(name, value):
+class env_change:
     """Context manager to temporarily change the value of an env var."""
-    # TODO: move this upstream to the biodome package
-    if name in environ:
-        old = environ[name]
-
-        def reset():
-            environ[name] = old
 
-    else:
+    # A plain class rather than @contextlib.contextmanager, which would set
+    # up a generator and its wrapper on every use. The previous values form a
+    # stack, so that one instance can be entered again while already active.
+    # Env var values are never None, so None marks "did not exist".
+    __slots__ = ("name", "value", "_old")
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self._old = []
+
+    def __enter__(self):
+        self._old.append(os.environ.get(self.name))
+        os.environ[self.name] = str(self.value)
+
+    def __exit__(self, *exc_info):
+        old = self._old.pop()
+        if old is None:
+            os.environ.pop(self.name, None)
+        else:
+            os.environ[self.name] = old
 
-        def reset():
-            del environ[name]
 
-    try:
-        environ[name] = value
-        yield
-    finally:
-        reset()
+# Env files are streamed line by line through a buffer this size, rather
+# than being read into memory whole.
+_ENV_FILE_BUFFER_SIZE = 64 * 1024
 
 
 def load_env_file(path, raises=False):
@@ -186,23 +397,28 @@ def load_env_file(path, raises=False):
 
     The name of the environment variable must be on the left and the value
     on the right. Each variable must be on its own line. Lines starting with
-    a # are considered comments and are ignored.
+    a # are considered comments and are ignored, as are lines without an =.
 
     :raises - If true, this method with raise if there is no file at the
         specified path. If false, the method will return having done nothing.
     """
     try:
-        with open(path) as f:
-            for line in f:  # pragma: no branch
-                line = line.strip()
-                if not line or line[0] == "#":
-                    continue
-                name, _, value = line.partition("=")
-                name = name.strip()
-                value = value.strip()
-                environ[name] = value
-    except IOError as e:
-        # Python 3 raises a FileNotFound and python 2 an IOError. So we can
-        # check the error number to see if it was a missing file.
-        if e.errno != errno.ENOENT or raises:
+        f = open(path, buffering=_ENV_FILE_BUFFER_SIZE)
+    except FileNotFoundError:
+        if raises:
             raise
+        return
+
+    # The values are all strings already, so they can go straight into
+    # os.environ in a single update rather than one by one through environ.
+    staged = {}
+    with f:
+        for line in f:
+            line = line.lstrip()
+            if not line or line[0] == "#":
+                continue
+            name, sep, value = line.partition("=")
+            name = name.rstrip()
+            if sep and name:
+                staged[name] = value.strip()
+    os.environ.update(staged)
@@ -0,0 +1,28 @@
+"""
+Optional compiled build of biodome.
+
+The package is built and published with flit (see pyproject.toml) and is
+pure Python. This script only exists to compile ``biodome.py`` unchanged
+with Cython, for a local speedup:
+
+    python setup.py build_ext --inplace
+
+The extension module is written next to ``biodome.py`` and is imported in
+preference to it. If Cython is not installed, or ``BIODOME_CYTHON=0`` is
+set, nothing is compiled and the plain module is used. Remember to rebuild
+(or delete the extension) after editing ``biodome.py``.
+"""
+import os
+
+from setuptools import setup
+
+ext_modules = []
+if os.environ.get("BIODOME_CYTHON", "1") != "0":
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        pass
+    else:
+        ext_modules = cythonize(["biodome.py"], language_level=3)
+
+setup(name="biodome", py_modules=["biodome"], ext_modules=ext_modules)
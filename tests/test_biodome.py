@@ -1,14 +1,16 @@
 import os
-import sys
 
-from copy import deepcopy
-from uuid import uuid4
+from decimal import Decimal
+from enum import Enum
+from itertools import count
+from unittest import mock
 
 import pytest
 import biodome
 
 
-PY2 = sys.version_info < (3, 0)
+# tmpdir is already unique per test, so a counter is enough for file names.
+ENV_FILE_NUMBERS = count()
 
 
 def test_missing():
@@ -61,6 +63,8 @@ def test_missing_default():
     ('X', False, '123', False),
     ('X', False, '____', False),
     ('X', False, 'heyy', False),
+    ('X', False, 'disabled_by_policy', False),
+    ('X', False, 'ACTIVATED', True),
 
     ('X', 123, 'heyy', 123),
     ('X', -123, '-123', -123),
@@ -81,6 +85,17 @@ def test_missing_default():
     ('X', [], '[', []),
     ('X', [], '[blah]', []),
     ('X', [], '["blah"]', ['blah']),
+    ('X', [], '([1])', [1]),
+    ('X', [], '', []),
+    ('X', {}, 'blah', {}),
+    ('X', (), '1, 2', (1, 2)),
+    ('X', [], '{"a": 1}', []),
+    ('X', {}, '[1]', {}),
+    ('X', {}, '({"a": 1})', {'a': 1}),
+    ('X', [], "['blah']", ['blah']),
+    ('X', [], '[true, null]', [True, None]),
+    ('X', [], '[Infinity, -Infinity]', [float('inf'), float('-inf')]),
+    ('X', {}, "{'a': (1, 2)}", dict(a=(1, 2))),
 
     ('X', (1, 2), 'blah', (1, 2)),
     ('X', (), 'blah', ()),
@@ -91,20 +106,34 @@ def test_missing_default():
     ('X', (), '(1,)', (1,)),
 
     ('X', '0', '1.053', '1.053'),
+    ('X', Decimal('1.5'), '2.25', Decimal('2.25')),
+    ('X', Decimal('1.5'), 'abc', Decimal('1.5')),
+
+    ('X', 0, ' 12\n', 12),
+    ('X', 0.0, ' 1.5 ', 1.5),
+    ('X', 0, '\x1c12', 12),
+    ('X', 0.0, '\x1f1.5\x1c', 1.5),
+    ('X', 'a', ' b ', 'b'),
+    ('X', True, ' yes\t', True),
+    ('X', [], ' [1] ', [1]),
+    ('X', (), ' (1,) ', (1,)),
 ])
 def test_param_set(name, default, setting, result):
-    os.environ[name] = str(setting)
+    os.environ[name] = setting
     assert biodome.biodome(name, default) == result
 
 
-@pytest.mark.skipif(PY2, reason="requires Python 3+")
 @pytest.mark.parametrize('name,default,setting,result', [
     ('X', {1, 2, 3}, '{1, 2}', {1, 2}),
     ('X', {1, 2, 3}, '{"1":2}', {1, 2, 3}),
+    ('X', {1}, '{"a", "b"}', {'a', 'b'}),
+    ('X', {1}, "{'a', (1, 2)}", {'a', (1, 2)}),
+    ('X', {1}, '{}', {1}),
+    ('X', {1}, '{1, [2]}', {1}),
+    ('X', {1}, '[1, 2]', {1}),
 ])
 def test_param(name, default, setting, result):
-    """ast.literal_eval is only supported in Python 3"""
-    os.environ[name] = str(setting)
+    os.environ[name] = setting
     assert biodome.biodome(name, default) == result
 
 
@@ -135,16 +164,15 @@ def test_param(name, default, setting, result):
     ('X', dict, '{"a": 123}', dict(a=123)),
 ])
 def test_cast(name, cast, setting, result):
-    os.environ[name] = str(setting)
+    os.environ[name] = setting
     assert biodome.biodome(name, cast=cast) == result
 
 
-@pytest.mark.skipif(PY2, reason="requires Python 3+")
 @pytest.mark.parametrize('name,cast,setting,result', [
     ('X', set, '{2}', {2}),
 ])
 def test_cast_set(name, cast, setting, result):
-    os.environ[name] = str(setting)
+    os.environ[name] = setting
     assert biodome.biodome(name, cast=cast) == result
 
 
@@ -155,7 +183,7 @@ def test_cast_set(name, cast, setting, result):
 ])
 def test_noeval(name, default, setting, result):
     """Verify that no code evaluation occurs"""
-    os.environ[name] = str(setting)
+    os.environ[name] = setting
     assert biodome.biodome(name, default=default) != result
     assert biodome.biodome(name, default=default) == default
 
@@ -234,9 +262,9 @@ def test_env_changer_existing():
 
 
 def test_loading_file(tmpdir):
-    p = tmpdir.join(str(uuid4()) + '.env')
+    p = tmpdir.join('env_' + str(next(ENV_FILE_NUMBERS)) + '.env')
     p.write_text(u'# This is a comment\nX_SET=123', 'utf8')
-    expected = deepcopy(biodome.environ.data)
+    expected = biodome.environ.data.copy()
     expected['X_SET'] = '123'
 
     biodome.load_env_file(str(p))
@@ -245,10 +273,25 @@ def test_loading_file(tmpdir):
     assert biodome.environ.get('X_SET', 1) == 123
 
 
+def test_loading_file_many_lines(tmpdir):
+    p = tmpdir.join('env_' + str(next(ENV_FILE_NUMBERS)) + '.env')
+    p.write_text(
+        u'# comment\r\n\r\nX_A = 1\r\n  # indented comment\nX_B=a=b\nX_A=2\n'
+        u'X_NO_VALUE\n = 3\n',
+        'utf8',
+    )
+    biodome.load_env_file(str(p))
+    assert biodome.environ.get('X_A', 0) == 2
+    assert biodome.environ['X_B'] == 'a=b'
+    assert 'X_NO_VALUE' not in biodome.environ
+    del biodome.environ['X_A']
+    del biodome.environ['X_B']
+
+
 def test_loading_empty_file(tmpdir):
-    p = tmpdir.join(str(uuid4()) + '.env')
+    p = tmpdir.join('env_' + str(next(ENV_FILE_NUMBERS)) + '.env')
     p.write('')
-    expected = deepcopy(biodome.environ.data)
+    expected = biodome.environ.data.copy()
 
     biodome.load_env_file(str(p))
     actual = biodome.environ.data
@@ -256,15 +299,15 @@ def test_loading_empty_file(tmpdir):
 
 
 def test_loading_missing_file(tmpdir):
-    p = str(tmpdir) + str(uuid4()) + '.env'
-    before = deepcopy(biodome.environ.data)
+    p = str(tmpdir) + 'env_' + str(next(ENV_FILE_NUMBERS)) + '.env'
+    before = biodome.environ.data.copy()
     biodome.load_env_file(str(p))
     assert biodome.environ.data == before
 
 
 def test_loading_missing_file_raises(tmpdir):
-    p = str(tmpdir) + str(uuid4()) + '.env'
-    before = deepcopy(biodome.environ.data)
+    p = str(tmpdir) + 'env_' + str(next(ENV_FILE_NUMBERS)) + '.env'
+    before = biodome.environ.data.copy()
     with pytest.raises(IOError):
         biodome.load_env_file(str(p), raises=True)
     assert biodome.environ.data == before
@@ -283,3 +326,233 @@ def test_cast_missing():
 def test_default_missing():
     x = biodome.environ.get('MISSING', default=123)
     assert x == 123
+
+
+def test_cache_sees_changes():
+    os.environ['CACHED'] = '1'
+    assert biodome.biodome('CACHED', 0) == 1
+    assert biodome.biodome('CACHED', 0) == 1
+    assert ('CACHED', int) in biodome._cache
+
+    # Changes made directly via os.environ must not be masked by the cache
+    os.environ['CACHED'] = '2'
+    assert biodome.biodome('CACHED', 0) == 2
+    biodome.environ['CACHED'] = 3
+    assert biodome.biodome('CACHED', cast=int) == 3
+
+    biodome.biodome.cache_clear()
+    assert not biodome._cache
+    assert biodome.biodome('CACHED', 0) == 3
+    del os.environ['CACHED']
+    assert biodome.biodome('CACHED', 0) == 0
+
+
+def test_cache_skips_mutable():
+    os.environ['CACHED'] = '[1, 2]'
+    value = biodome.biodome('CACHED', [])
+    value.append(3)
+    assert biodome.biodome('CACHED', []) == [1, 2]
+
+    os.environ['CACHED'] = '(1, [2])'
+    value = biodome.biodome('CACHED', ())
+    value[1].append(3)
+    assert biodome.biodome('CACHED', ()) == (1, [2])
+    assert ('CACHED', tuple) not in biodome._cache
+    del os.environ['CACHED']
+
+
+def test_cache_tuple():
+    os.environ['CACHED'] = '(1, "a")'
+    assert biodome.biodome('CACHED', ()) == (1, 'a')
+    assert biodome._cache[('CACHED', tuple)] == ('(1, "a")', (1, 'a'))
+    assert biodome.biodome('CACHED', ()) == (1, 'a')
+    del os.environ['CACHED']
+
+
+def test_environ_mapping():
+    biodome.environ['blah'] = 1
+    assert 'blah' in biodome.environ
+    assert 'blah' in list(biodome.environ)
+    assert len(biodome.environ) == len(os.environ)
+    assert dict(biodome.environ.items()) == dict(os.environ)
+    assert biodome.environ.pop('blah') == '1'
+    assert 'blah' not in os.environ
+    with pytest.raises(KeyError):
+        biodome.environ['blah']
+    with pytest.raises(AttributeError):
+        biodome.environ.x = 1
+
+
+@pytest.mark.parametrize('default,cast,setting,result', [
+    (None, None, None, None),
+    (None, None, ' 1 ', ' 1 '),
+    (False, None, None, False),
+    (False, None, 'yes', True),
+    (0, None, 'blah', 0),
+    (0, None, '12', 12),
+    ([], None, '[1, 2]', [1, 2]),
+    ((), None, '[1, 2]', ()),
+    (None, int, None, TypeError),
+    (None, lambda v: v or 'x', None, 'x'),
+    (None, bool, 'on', True),
+    (None, float, 'blah', None),
+])
+def test_callable_matches_get(default, cast, setting, result):
+    if setting is None:
+        os.environ.pop('MY_SETTING3', None)
+    else:
+        os.environ['MY_SETTING3'] = setting
+    MY_SETTING3 = biodome.environ.get_callable('MY_SETTING3', default, cast=cast)
+    if result is TypeError:
+        with pytest.raises(TypeError):
+            MY_SETTING3()
+    else:
+        assert MY_SETTING3() == result
+        assert biodome.environ.get('MY_SETTING3', default, cast=cast) == result
+    os.environ.pop('MY_SETTING3', None)
+
+
+def test_callable_incompatible_arguments():
+    with pytest.raises(ValueError):
+        biodome.environ.get_callable('ABC', default=1, cast=bool)
+
+
+def test_materialize():
+    os.environ['M_INT'] = '5'
+    os.environ['M_BOOL'] = 'yes'
+    os.environ['M_LIST'] = '[1, 2]'
+    os.environ['M_STR'] = ' raw '
+    os.environ['M_BAD'] = 'blah'
+    schema = dict(
+        M_INT=0, M_BOOL=False, M_LIST=[], M_STR=None, M_BAD=1.5, M_MISSING=3,
+    )
+    assert biodome.materialize(schema) == dict(
+        M_INT=5, M_BOOL=True, M_LIST=[1, 2], M_STR=' raw ', M_BAD=1.5,
+        M_MISSING=3,
+    )
+    assert biodome.materialize(schema) == {
+        name: biodome.biodome(name, default) for name, default in schema.items()
+    }
+    for name in schema:
+        os.environ.pop(name, None)
+
+
+def test_cast_error_propagates():
+    def cast(value):
+        raise KeyError(value)
+
+    os.environ['X'] = 'blah'
+    with pytest.raises(KeyError):
+        biodome.biodome('X', cast=cast)
+    assert biodome.biodome('X', cast=lambda value: int(value)) is None
+
+
+def test_cast_failure_logged(caplog):
+    os.environ['X'] = 'blah'
+    assert biodome.biodome('X', 1) == 1
+    assert caplog.messages == [
+        "Env var X: cast \"blah\" to type <class 'int'> failed. "
+        "The default will be used."
+    ]
+
+
+def test_env_changer_nested():
+    with biodome.env_change('BLAH', 1):
+        with biodome.env_change('BLAH', 2):
+            assert biodome.environ.get('BLAH', 0) == 2
+        assert biodome.environ.get('BLAH', 0) == 1
+
+    assert 'BLAH' not in biodome.environ
+
+
+def test_env_changer_exception():
+    with pytest.raises(ZeroDivisionError):
+        with biodome.env_change('BLAH', 123):
+            1 / 0
+
+    assert 'BLAH' not in biodome.environ
+
+
+def test_env_changer_deleted_inside():
+    with biodome.env_change('BLAH', 123):
+        del biodome.environ['BLAH']
+
+    assert 'BLAH' not in biodome.environ
+
+
+def test_callable_sees_changes():
+    os.environ['MY_SETTING4'] = '1'
+    MY_SETTING4 = biodome.environ.get_callable('MY_SETTING4', False)
+    assert MY_SETTING4() is True
+    assert MY_SETTING4() is True
+    os.environ['MY_SETTING4'] = 'off'
+    assert MY_SETTING4() is False
+    with biodome.env_change('MY_SETTING4', 'yes'):
+        assert MY_SETTING4() is True
+    del os.environ['MY_SETTING4']
+    assert MY_SETTING4() is False
+
+
+class Scaled:
+    """A callable cast that can't be hashed (it defines __eq__ only)."""
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __eq__(self, other):
+        return isinstance(other, Scaled) and other.factor == self.factor
+
+    def __call__(self, value):
+        return int(value) * self.factor
+
+
+def test_cast_unhashable_callable():
+    os.environ['N'] = '3'
+    assert biodome.biodome('N', cast=Scaled(10)) == 30
+    assert biodome.environ.get_callable('N', cast=Scaled(10))() == 30
+    os.environ['N'] = 'blah'
+    assert biodome.biodome('N', cast=Scaled(10)) is None
+    del os.environ['N']
+
+
+class Setting(str, Enum):
+    DEBUG = 'MY_DEBUG'
+
+
+def test_callable_str_enum_key():
+    os.environ['MY_DEBUG'] = 'yes'
+    DEBUG = biodome.environ.get_callable(Setting.DEBUG, False)
+    assert DEBUG() is True
+    assert biodome.environ.get(Setting.DEBUG, False) is True
+    del os.environ['MY_DEBUG']
+    assert DEBUG() is False
+
+
+def test_replaced_os_environ():
+    with mock.patch.object(os, 'environ', {'PX': '7'}):
+        assert biodome.biodome('PX') == '7'
+        assert biodome.environ.get('PX', 0) == 7
+        assert biodome.environ.get_callable('PX')() == '7'
+        assert biodome.environ.get_callable('PX', 0)() == 7
+        assert biodome.materialize(dict(PX=0)) == dict(PX=7)
+        with biodome.env_change('PX', 8):
+            assert os.environ['PX'] == '8'
+        assert os.environ == {'PX': '7'}
+
+
+def test_env_changer_reused():
+    cm = biodome.env_change('R', 1)
+    with cm:
+        with cm:
+            assert os.environ['R'] == '1'
+        assert os.environ['R'] == '1'
+    assert 'R' not in os.environ
+
+    os.environ['R'] = '0'
+    with cm:
+        assert os.environ['R'] == '1'
+    assert os.environ['R'] == '0'
+    with cm:
+        assert os.environ['R'] == '1'
+    assert os.environ['R'] == '0'
+    del os.environ['R']